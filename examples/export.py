@@ -22,9 +22,12 @@
 # Networks", CVPR'19 (https://arxiv.org/abs/1904.08755) if you use any part
 # of the code.
 import os
+import json
 import argparse
+import threading
 import math
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from urllib.request import urlretrieve
 
 try:
@@ -48,6 +51,10 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--file_name', type=str, default='1.ply')
 parser.add_argument('--weights', type=str, default='weights.pth')
 parser.add_argument('--use_cpu', action='store_true')
+parser.add_argument('--dense_im2col', action='store_true',
+                    help='always export the dense im2col matrix')
+parser.add_argument('--sparse_im2col_density', type=float, default=0.1,
+                    help='export im2col in COO format below this voxel density')
 
 CLASS_LABELS = ('wall', 'floor', 'cabinet', 'bed', 'chair', 'sofa', 'table',
                 'door', 'window', 'bookshelf', 'picture', 'counter', 'desk',
@@ -100,6 +107,37 @@ SCANNET_COLOR_MAP = {
     40: (100., 85., 144.),
 }
 
+# (20, 3) colors in [0, 1] indexed by the predicted label
+SCANNET_COLOR_LUT = np.array(
+    [SCANNET_COLOR_MAP[c] for c in VALID_CLASS_IDS], dtype=np.float64) / 255
+
+# origin passed as min_coordinate to SparseTensor.dense, which requires a CPU IntTensor
+_MIN_CRD = torch.zeros(3, dtype=torch.int32)
+
+class BoundedThreadPoolExecutor(ThreadPoolExecutor):
+    r"""
+    A `ThreadPoolExecutor` whose `submit` blocks while `max_workers` tasks are
+    pending, so that at most that many arrays wait in host memory.
+    """
+
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            future = super().submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+# serializes the exported tensors in the background so that the forward pass
+# does not wait on disk I/O
+executor = BoundedThreadPoolExecutor(max_workers=4)
+
 
 def load_file(file_name):
     pcd = o3d.io.read_point_cloud(file_name)
@@ -116,22 +154,101 @@ def normalize_color(color: torch.Tensor, is_color_in_range_0_255: bool = False)
     `color` (torch.Tensor): Nx3 color feature matrix
     `is_color_in_range_0_255` (bool): If the color is in range [0, 255] not [0, 1], normalize the color to [0, 1].
     """
+    color = color.float()
     if is_color_in_range_0_255:
-        color /= 255
-    color -= 0.5
-    return color.float()
+        color.mul_(1.0 / 255.0)
+    return color.sub_(0.5)
+
+class TensorArchive:
+    r"""
+    Append arrays to a single raw file `path.bin` instead of one file per
+    array. The byte offset, shape and dtype of each array are written to the
+    sidecar `path.json` on close, so that an array can be read back with
+    `np.memmap(path + '.bin', dtype, 'r', offset, shape)`. Arrays with no
+    elements have no data region and are read back as `np.empty(shape, dtype)`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(f"{path}.bin", 'wb')
+        self.index = {}
+        self.futures = []
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def submit(self, executor, key, arr):
+        # reserve the region now so that the layout follows the submission order
+        arr = np.ascontiguousarray(arr)
+        with self.lock:
+            offset = self.offset
+            self.offset += arr.nbytes
+            self.index[key] = {'offset': offset, 'shape': list(arr.shape), 'dtype': arr.dtype.str}
+        if arr.nbytes == 0:
+            # nothing to write, and memoryview cannot cast zero-size arrays
+            return None
+        future = executor.submit(self._write, offset, arr)
+        self.futures.append((key, future))
+        return future
+
+    def _write(self, offset, arr):
+        # each array owns its region, so the writes need neither a seek nor the lock
+        view = memoryview(arr).cast('B')
+        while view:
+            written = os.pwrite(self.file.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+
+    def close(self):
+        # wait for the pending writes, failed arrays are left out of the index
+        errors = []
+        for key, future in self.futures:
+            try:
+                future.result()
+            except Exception as e:
+                del self.index[key]
+                errors.append(e)
+        self.file.close()
+        with open(f"{self.path}.json", 'w') as f:
+            json.dump(self.index, f, indent=2)
+        if errors:
+            raise errors[0]
 
 def EnsureDirExists(dir):
     if not os.path.exists(dir):
         print("Creating %s" % dir)
         os.makedirs(dir)
 
+def _compile(fn):
+    # torch.compile is only available from torch 2.0
+    if hasattr(torch, 'compile'):
+        return torch.compile(fn, fullgraph=False, dynamic=True)
+    return fn
+
+# a single flat im2col output buffer reused across layers, grown to the largest
+# layer so that peak memory is that of the largest im2col matrix
+_buf = None
+
+def _get_buffer(shape, dtype, device):
+    global _buf
+    numel = math.prod(shape)
+    if _buf is None or _buf.numel() < numel or _buf.dtype != dtype or _buf.device != device:
+        # free the old buffer before allocating a larger one
+        _buf = None
+        _buf = torch.empty(numel, dtype=dtype, device=device)
+    return _buf[:numel].view(shape)
+
+# torch.inference_mode is only available from torch 1.9
+_inference_mode = torch.inference_mode if hasattr(torch, 'inference_mode') else torch.no_grad
+
 # assuming uniform kernel size, stride, padding
-# assuming input_data is 5D tensor, in sparse tensor format
-def im2col_3d(input_sparse, kernel_size, stride=1, padding=0):
+# assuming input_data is the 5D dense tensor of a sparse tensor with coordinates
+# coords, i.e. the output of SparseTensor.dense(), which is kept out of the
+# compiled region
+# out optionally provides the (B, D', H', W', C, K, K, K) output buffer, see _get_buffer
+@_inference_mode()
+@_compile
+def im2col_3d(input_data, coords, min_coordinate, tensor_stride, kernel_size, stride=1, padding=0, out=None):
     assert stride == 1, "stride must be 1"
-    # convert to dense tensor
-    input_data, min_coordinate, tensor_stride = input_sparse.dense(min_coordinate=torch.IntTensor([0, 0, 0]))
 
     if padding > 0:
         input_data = torch.nn.functional.pad(input_data, (padding, padding, padding, padding, padding, padding))
@@ -144,60 +261,114 @@ def im2col_3d(input_sparse, kernel_size, stride=1, padding=0):
     out_height = math.ceil((height - kernel_size + 1) / stride)
     out_width = math.ceil((width - kernel_size + 1) / stride)
 
-    # Create the output matrix
-    # not enforcing output sparsity pattern
-    col_unconstrained = torch.zeros(
-        (batch_size, channels, kernel_size, kernel_size, kernel_size, out_depth, out_height, out_width),
-        device=input_data.device
-    )
+    # Extract the patches from the input data
+    # not enforcing output sparsity pattern, this is a view and allocates nothing
+    # (B, C, D', H', W', K, K, K) -> (B, C, K, K, K, D', H', W')
+    patches = input_data.unfold(2, kernel_size, stride) \
+                        .unfold(3, kernel_size, stride) \
+                        .unfold(4, kernel_size, stride) \
+                        .permute(0, 1, 5, 6, 7, 2, 3, 4)
     # enforced output sparsity pattern
-    col = torch.zeros(
-        (batch_size, channels, kernel_size, kernel_size, kernel_size, out_depth, out_height, out_width),
-        device=input_data.device
-    )
-
-    # Fill the output matrix with patches from the input data
-    for z in range(0, kernel_size):
-        z_max = z + stride * out_depth
-        for y in range(0, kernel_size):
-            y_max = y + stride * out_height
-            for x in range(0, kernel_size):
-                x_max = x + stride * out_width
-                col_unconstrained[:, :, z, y, x, :, :, :] = input_data[:, :, z:z_max:stride, y:y_max:stride, x:x_max:stride]
-
-    # enforce output sparsity pattern
+    # laid out as (B, D', H', W', C, K, K, K) so that the final reshape is free
+    if out is None:
+        col = torch.zeros(
+            (batch_size, out_depth, out_height, out_width, channels, kernel_size, kernel_size, kernel_size),
+            dtype=input_data.dtype,
+            device=input_data.device
+        )
+    else:
+        assert out.shape == (batch_size, out_depth, out_height, out_width, channels, kernel_size, kernel_size, kernel_size), \
+            f"out has shape {tuple(out.shape)}"
+        col = out.zero_()
+
     # only non zero output when input at the same coordinate is non-zero
-    for i in range(input_sparse.coordinates.shape[0]):
-        crds = input_sparse.coordinates[i].tolist()
-        batch = crds[0]
-        # sparse_crd = min_crd + tensor_stride * dense_crd
-        z = (crds[1] - min_coordinate[0, 0]) // tensor_stride[0]
-        y = (crds[2] - min_coordinate[0, 1]) // tensor_stride[1]
-        x = (crds[3] - min_coordinate[0, 2]) // tensor_stride[2]
-        col[batch, :, :, :, :, z, y, x] = col_unconstrained[batch, :, :, :, :, z, y, x]
-
-    col = col.view(batch_size, -1, out_depth*out_height*out_width).transpose(1, 2).contiguous()
+    # keep the index arithmetic on the coordinate device to avoid host syncs
+    crds = coords.long()
+    batch = crds[:, 0]
+    # sparse_crd = min_crd + tensor_stride * dense_crd
+    dense_crds = (crds[:, 1:] - min_coordinate.to(crds)) // tensor_stride.to(crds)
+    z, y, x = dense_crds.unbind(1)
+    col[batch, z, y, x] = patches[batch, :, :, :, :, z, y, x]
+
     col = col.view(batch_size*out_depth*out_height*out_width, -1)
 
     return col
 
+# sparse counterpart of im2col_3d, returns the nonzeros of the same matrix in
+# COO format without materializing it
+@_inference_mode()
+def im2col_3d_sparse(input_data, coords, min_coordinate, tensor_stride, kernel_size, stride=1, padding=0):
+    assert stride == 1, "stride must be 1"
+
+    if padding > 0:
+        input_data = torch.nn.functional.pad(input_data, (padding, padding, padding, padding, padding, padding))
+
+    # Get input dimensions
+    batch_size, channels, depth, height, width = input_data.size()
+
+    # Calculate the dimensions of the output matrix
+    out_depth = math.ceil((depth - kernel_size + 1) / stride)
+    out_height = math.ceil((height - kernel_size + 1) / stride)
+    out_width = math.ceil((width - kernel_size + 1) / stride)
+
+    # only the rows at the input coordinates can be non zero
+    crds = coords.long()
+    batch = crds[:, 0]
+    # sparse_crd = min_crd + tensor_stride * dense_crd
+    dense_crds = (crds[:, 1:] - min_coordinate.to(crds)) // tensor_stride.to(crds)
+    z, y, x = dense_crds.unbind(1)
+    rows = ((batch * out_depth + z) * out_height + y) * out_width + x
+
+    # (K^3, 3) kernel offsets in the same order as the im2col columns
+    offset = torch.arange(kernel_size, device=crds.device)
+    kernel_offsets = torch.cartesian_prod(offset, offset, offset)
+
+    # (N, K^3, C) -> (N, C * K^3)
+    patches = input_data[
+        batch[:, None], :,
+        z[:, None] + kernel_offsets[:, 0],
+        y[:, None] + kernel_offsets[:, 1],
+        x[:, None] + kernel_offsets[:, 2]]
+    patches = patches.transpose(1, 2).reshape(len(crds), -1)
+
+    row_idx, col_idx = patches.nonzero(as_tuple=True)
+    indices = torch.stack((rows[row_idx], col_idx))
+    values = patches[row_idx, col_idx]
+    shape = (batch_size * out_depth * out_height * out_width, channels * kernel_size ** 3)
+
+    return indices, values, shape
+
 def get_activation(name, mode, dir, in_activation, out_activation, kernel_size, stride, unsqueeze=False):
     def in_hook(model, input, output):
         for i in range(len(input)):
             in_activation[name+"."+str(i)] = input[i].detach()
-            input_dense = input[i].dense(min_coordinate=torch.IntTensor([0, 0, 0]))[0]
+            # the dense tensor is shared by the logging and im2col below
+            input_dense, min_coordinate, tensor_stride = input[i].detach().dense(min_coordinate=_MIN_CRD)
             print(f"[in] {name=} in{i} {input[i].shape=} {input_dense.shape=} density={torch.count_nonzero(input[i].features)/input[i].features.numel()}")
 
             # Get input dimensions
             batch_size, channels, depth, height, width = input_dense.size()
-            if stride == 1: # can only do stride 1
-                col = im2col_3d(input[i].detach(), kernel_size, stride, kernel_size//2)
+            voxel_density = len(input[i].coordinates) / (batch_size * depth * height * width)
+            if stride == 1 and not config.dense_im2col and voxel_density < config.sparse_im2col_density:
+                indices, values, shape = im2col_3d_sparse(input_dense, input[i].coordinates, min_coordinate, tensor_stride, kernel_size, stride, kernel_size//2)
+                print(f"[im2col] {name=} {kernel_size=} {stride=} {shape=} {values.numel()=} density={values.numel()/(shape[0]*shape[1])}")
+                archive.submit(executor, f"{name}.{i}.coo.indices", indices.cpu().numpy())
+                archive.submit(executor, f"{name}.{i}.coo.values", values.detach().to(torch.float16).cpu().numpy())
+                archive.submit(executor, f"{name}.{i}.coo.shape", np.array(shape))
+            elif stride == 1: # can only do stride 1
+                # stride 1 with kernel_size//2 padding preserves the spatial size for odd kernels
+                padding = kernel_size//2
+                out_size = [s + 2 * padding - kernel_size + 1 for s in (depth, height, width)]
+                buf = _get_buffer((batch_size, *out_size, channels, kernel_size, kernel_size, kernel_size), input_dense.dtype, input_dense.device)
+                col = im2col_3d(input_dense, input[i].coordinates, min_coordinate, tensor_stride, kernel_size, stride, padding, out=buf)
                 print(f"[im2col] {name=} {kernel_size=} {stride=} {col.shape=} {torch.count_nonzero(col)=} density={torch.count_nonzero(col)/col.numel()}")
-                np.save(f"{tensor_dir}/in/{name}.{i}.npy", col.cpu().numpy())
+                # stored in half precision, always copied since col aliases a reused buffer
+                arr = col.detach().to('cpu', torch.float16, copy=True).numpy()
+                archive.submit(executor, f"{name}.{i}", arr)
 
     def out_hook(model, input, output):
         out_activation[name] = output.detach()
-        print(f"[out] {name=} {output.shape=} {output.dense(min_coordinate=torch.IntTensor([0, 0, 0]))[0].shape=}")
+        print(f"[out] {name=} {output.shape=} {output.dense(min_coordinate=_MIN_CRD)[0].shape=}")
         # TODO: save the output
         #saveTensor(args, name, mode, output.detach(), unsqueeze)
     if mode == 'in':
@@ -207,6 +378,16 @@ def get_activation(name, mode, dir, in_activation, out_activation, kernel_size,
     else:
         assert False
 
+# a single forward hook running both the 'in' and 'out' paths
+def get_activation_both(name, dir, in_activation, out_activation, kernel_size, stride, unsqueeze=False):
+    in_hook = get_activation(name, 'in', dir, in_activation, out_activation, kernel_size, stride, unsqueeze)
+    out_hook = get_activation(name, 'out', dir, in_activation, out_activation, kernel_size, stride, unsqueeze)
+    def hook(model, input, output):
+        with _inference_mode():
+            in_hook(model, input, output)
+            out_hook(model, input, output)
+    return hook
+
 if __name__ == '__main__':
     config = parser.parse_args()
     device = torch.device('cuda' if (
@@ -222,6 +403,7 @@ if __name__ == '__main__':
     EnsureDirExists(os.path.join(tensor_dir, 'weight'))
     EnsureDirExists(os.path.join(tensor_dir, 'in'))
     EnsureDirExists(os.path.join(tensor_dir, 'out'))
+    archive = TensorArchive(f"{tensor_dir}/in/all")
 
     in_activation = {}
     out_activation = {}
@@ -233,36 +415,45 @@ if __name__ == '__main__':
             #saveTensor(args, n, 'weight', m.weight) # alexnet have bias, ignore it for now
             weight = m.kernel.detach().transpose(0, 1).contiguous()
             K = weight.shape[-1]
-            weight = weight.view(-1, K).cpu().numpy()
+            weight = weight.view(-1, K).to(torch.float16).cpu().numpy()
             print("[weight reshaped]", n, m, weight.shape)
-            np.save(f"{tensor_dir}/weight/{n}.npy", weight)
+            np.save(f"{tensor_dir}/weight/{n}.fp16.npy", weight)
 
-            handle1 = m.register_forward_hook(get_activation(n, 'in', tensor_dir, in_activation, out_activation, m.kernel_generator.kernel_size[0], m.kernel_generator.kernel_stride[0]))
-            handle2 = m.register_forward_hook(get_activation(n, 'out', tensor_dir, in_activation, out_activation, m.kernel_generator.kernel_size[0], m.kernel_generator.kernel_stride[0]))
-            hooks.append(handle1)
-            hooks.append(handle2)
+            handle = m.register_forward_hook(get_activation_both(n, tensor_dir, in_activation, out_activation, m.kernel_generator.kernel_size[0], m.kernel_generator.kernel_stride[0]))
+            hooks.append(handle)
 
     coords, colors, pcd = load_file(config.file_name)
     # Measure time
-    with torch.no_grad():
-        voxel_size = 0.02
-        # Feed-forward pass and get the prediction
-        in_field = ME.TensorField(
-            features=normalize_color(torch.from_numpy(colors)),
-            coordinates=ME.utils.batched_coordinates([coords / voxel_size], dtype=torch.float32),
-            quantization_mode=ME.SparseTensorQuantizationMode.UNWEIGHTED_AVERAGE,
-            minkowski_algorithm=ME.MinkowskiAlgorithm.SPEED_OPTIMIZED,
-            device=device,
-        )
-        # Convert to a sparse tensor
-        sinput = in_field.sparse()
-        # Output sparse tensor
-        soutput = model(sinput)
-        print(sinput.shape)
-        print(soutput.shape)
-        # get the prediction on the input tensor field
-        out_field = soutput.slice(in_field)
-        logits = out_field.F
+    try:
+        with torch.no_grad():
+            voxel_size = 0.02
+            # Feed-forward pass and get the prediction
+            # divide in float64 before casting, as the host `coords / voxel_size`
+            # did, so that the points land in the same voxels. The division is
+            # out of place since on CPU the tensor shares memory with `coords`
+            coords_t = torch.from_numpy(coords).to(device).div(voxel_size).float()
+            colors_t = torch.from_numpy(colors).to(device=device, dtype=torch.float32)
+            in_field = ME.TensorField(
+                features=normalize_color(colors_t),
+                coordinates=ME.utils.batched_coordinates([coords_t], dtype=torch.float32, device=device),
+                quantization_mode=ME.SparseTensorQuantizationMode.UNWEIGHTED_AVERAGE,
+                minkowski_algorithm=ME.MinkowskiAlgorithm.SPEED_OPTIMIZED,
+                device=device,
+            )
+            # Convert to a sparse tensor
+            sinput = in_field.sparse()
+            # Output sparse tensor
+            soutput = model(sinput)
+            print(sinput.shape)
+            print(soutput.shape)
+            # get the prediction on the input tensor field
+            out_field = soutput.slice(in_field)
+            logits = out_field.F
+    finally:
+        # release the im2col buffer, the hooks are done with it
+        _buf = None
+        # write the index even on partial runs
+        archive.close()
 
     _, pred = logits.max(1)
     pred = pred.cpu().numpy()
@@ -270,12 +461,15 @@ if __name__ == '__main__':
     # Create a point cloud file
     pred_pcd = o3d.geometry.PointCloud()
     # Map color
-    colors = np.array([SCANNET_COLOR_MAP[VALID_CLASS_IDS[l]] for l in pred])
+    colors = SCANNET_COLOR_LUT[pred]
     pred_pcd.points = o3d.utility.Vector3dVector(coords)
-    pred_pcd.colors = o3d.utility.Vector3dVector(colors / 255)
+    pred_pcd.colors = o3d.utility.Vector3dVector(colors)
     pred_pcd.estimate_normals()
 
     # Move the original point cloud
     pcd.points = o3d.utility.Vector3dVector(
         np.array(pcd.points) + np.array([0, 5, 0]))
 
+    # wait for the pending saves
+    executor.shutdown(wait=True)
+